@@ -1,74 +1,333 @@
 # excel.py (Cross-platform version for macOS/Linux)
 
+import importlib.util
+import re
+import numpy as np
 import pandas as pd
 import openpyxl
 import warnings
 
+# Numba is optional - without it the per-group summaries use pandas' groupby
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
 warnings.filterwarnings('ignore')
 
+# Arrow-backed strings make slicer comparisons vectorised; pyarrow ships with streamlit
+_STRING_DTYPE = 'string[pyarrow]' if importlib.util.find_spec('pyarrow') else 'string'
 
-# Load full sheet using pandas
-def load_excel_data(file_path: str, sheet_name: str) -> pd.DataFrame:
-    """Load Excel data using pandas - works on all platforms"""
+# Slicer values containing any of these look like totals/summaries, not real members
+_SKIP_TERMS = ('total', 'grand total', 'sum', 'average', 'avg', '(blank)', 'blank')
+_SKIP_RE = re.compile('|'.join(re.escape(term) for term in _SKIP_TERMS), re.IGNORECASE)
+
+# calamine parses a sheet's whole range even when asked for fewer rows or columns
+CALAMINE_AVAILABLE = importlib.util.find_spec('python_calamine') is not None
+
+# Parsed sheets keyed by (file_path, sheet_name, usecols) so each sheet is read only once
+_SHEET_CACHE: dict[tuple[str, str, tuple | None], pd.DataFrame] = {}
+
+
+# Stream an .xlsx sheet through openpyxl's read-only mode instead of loading the whole workbook
+def _read_xlsx_read_only(file_path: str, sheet_name: str, usecols: list = None, nrows: int = None) -> pd.DataFrame:
+    # `usecols` holds column positions, as returned by select_analysis_columns()
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True, keep_links=False)
     try:
-        # For .xlsb files, we need to use a different engine
+        rows = workbook[sheet_name].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return pd.DataFrame()
+
+        # Match read_excel's naming for blank header cells
+        columns = [col if col is not None else f"Unnamed: {i}" for i, col in enumerate(header)]
+        positions = range(len(columns)) if usecols is None else [i for i in usecols if i < len(columns)]
+
+        data = []
+        for row in rows:
+            if nrows is not None and len(data) >= nrows:
+                break
+            data.append([row[i] if i < len(row) else None for i in positions])
+
+        return pd.DataFrame(data, columns=[columns[i] for i in positions])
+    finally:
+        workbook.close()
+
+
+def _read_sheet(file_path: str, sheet_name: str, usecols: list = None, nrows: int = None) -> pd.DataFrame:
+    # calamine (Rust) reads both .xlsx and .xlsb far faster than openpyxl/pyxlsb
+    try:
+        return pd.read_excel(file_path, sheet_name=sheet_name, engine='calamine', usecols=usecols, nrows=nrows)
+    except ImportError:
         if file_path.endswith('.xlsb'):
-            return pd.read_excel(file_path, sheet_name=sheet_name, engine='pyxlsb')
-        else:
-            return pd.read_excel(file_path, sheet_name=sheet_name, engine='openpyxl')
+            return pd.read_excel(file_path, sheet_name=sheet_name, engine='pyxlsb', usecols=usecols, nrows=nrows)
+        return _read_xlsx_read_only(file_path, sheet_name, usecols=usecols, nrows=nrows)
+
+
+# Load full sheet using pandas
+def load_excel_data(file_path: str, sheet_name: str, usecols: list = None) -> pd.DataFrame:
+    """Load Excel data using pandas - works on all platforms
+
+    Pass `usecols` (column positions, e.g. from select_analysis_columns()) to keep only those columns.
+    If the full sheet is already cached they are selected from it, and the narrower frame replaces
+    it in the cache; otherwise only those columns are parsed.
+    The parsed sheet is cached, so repeated calls for the same sheet are free.
+    Callers must treat the returned DataFrame as read-only.
+    """
+    key = (file_path, sheet_name, tuple(usecols) if usecols is not None else None)
+    if key in _SHEET_CACHE:
+        return _SHEET_CACHE[key]
+
+    full_key = (file_path, sheet_name, None)
+    if full_key in _SHEET_CACHE:
+        _SHEET_CACHE[key] = _SHEET_CACHE.pop(full_key).iloc[:, list(usecols)]
+        return _SHEET_CACHE[key]
+
+    try:
+        df = _categorize_text_columns(_read_sheet(file_path, sheet_name, usecols=usecols))
     except Exception as e:
         print(f"❌ Error loading {file_path}: {e}")
         raise
 
+    _SHEET_CACHE[key] = df
+    return df
+
+
+# Text columns with fewer distinct values than this share of rows are stored as categories
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
+
+
+def _categorize_text_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Convert low-cardinality object columns to category so filters compare integer codes"""
+    if len(df) == 0:
+        return df
+
+    for col in df.select_dtypes(include=['object']).columns:
+        if df[col].nunique() / len(df) < CATEGORY_MAX_UNIQUE_RATIO:
+            df[col] = df[col].astype('category')
+    return df
+
+
+# Rows read when probing a sheet's header and column types
+SAMPLE_ROWS = 200
+
+
+def read_sheet_probe(file_path: str, sheet_name: str, nrows: int = SAMPLE_ROWS) -> pd.DataFrame:
+    """
+    Read a sheet with all of its columns, to pick the columns worth keeping.
+    With calamine this is the whole sheet, parsed once and cached for load_excel_data(),
+    since calamine parses the full range anyway; otherwise the header and first `nrows` rows (not cached).
+    """
+    if CALAMINE_AVAILABLE:
+        return load_excel_data(file_path, sheet_name)
+    return _read_sheet(file_path, sheet_name, nrows=nrows)
+
+
+def select_analysis_columns(sample: pd.DataFrame, slicer_names: list):
+    """
+    Given a frame from read_sheet_probe(), return the positions of the columns worth
+    loading: the slicer columns plus every column that looks numeric. Positions rather
+    than names, since headers can be a mix of strings, numbers and dates.
+    Returns None (load everything) when none of the slicers can be found.
+    """
+    slicer_columns = [col for col in resolve_slicer_columns(sample, slicer_names).values() if col is not None]
+    if not slicer_columns:
+        return None
+
+    numeric_columns = sample.select_dtypes(include=['number']).columns
+    return [i for i, col in enumerate(sample.columns) if col in slicer_columns or col in numeric_columns]
+
+
+def _skip_term_mask(values: pd.Index) -> np.ndarray:
+    """Boolean mask of values that look like totals or summaries"""
+    # One precompiled regex search per value instead of a lower() + scan per term
+    return np.fromiter((_SKIP_RE.search(val) is not None for val in values), dtype=bool, count=len(values))
+
+
+# Find the column backing a slicer (case-insensitive, partial match)
+def resolve_slicer_column(df: pd.DataFrame, slicer_name: str):
+    """Return the first column matching the slicer name, or None if there is no match"""
+    slicer_lower = slicer_name.lower()
+
+    # Lowercase every column name once; an exact match is also a substring match
+    for col_lower, col in zip(df.columns.astype(str).str.strip().str.lower(), df.columns):
+        if slicer_lower in col_lower or col_lower in slicer_lower:
+            return col
+
+    # Try exact match as a last resort
+    if slicer_name in df.columns:
+        return slicer_name
+
+    return None
+
+
+def resolve_slicer_columns(df: pd.DataFrame, slicer_names: list) -> dict:
+    """Resolve every slicer to its column once, so the fuzzy match isn't repeated per combination"""
+    return {name: resolve_slicer_column(df, name) for name in slicer_names}
+
+
+# Normalise slicer columns once per sheet so filtering never re-stringifies them
+def _normalize_slicer_column(series: pd.Series) -> pd.Series:
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # Strip the categories instead of every row; stripping may merge categories, so remap the codes
+        stripped = series.cat.categories.astype(_STRING_DTYPE).str.strip()
+        remap, categories = pd.factorize(stripped)
+        codes = np.append(remap, -1)[series.cat.codes.to_numpy()]
+        return pd.Series(pd.Categorical.from_codes(codes, categories=categories),
+                         index=series.index, name=series.name)
+
+    return series.astype(_STRING_DTYPE).str.strip()
+
+
+def prepare_sheet(df: pd.DataFrame, slicer_names: list) -> dict:
+    """
+    Return {slicer: stripped Series} for every slicer that resolves to a column.
+    Category columns stay categorical, so comparisons against them are integer code compares.
+    Build this once per sheet and pass it to build_slicer_index() / refresh_pivot_and_read().
+    """
+    slicer_columns = resolve_slicer_columns(df, slicer_names)
+    return {name: _normalize_slicer_column(df[col])
+            for name, col in slicer_columns.items() if col is not None}
+
+
+def _slicer_matches(normalized: pd.Series, value: str) -> np.ndarray:
+    """Boolean row mask of a normalised slicer column equal to `value`"""
+    if isinstance(normalized.dtype, pd.CategoricalDtype):
+        # Compare the integer codes directly; a value that isn't a category matches nothing
+        categories = normalized.cat.categories
+        if value not in categories:
+            return np.zeros(len(normalized), dtype=bool)
+        return normalized.cat.codes.to_numpy() == categories.get_loc(value)
+
+    return (normalized.array == value).to_numpy(dtype=bool, na_value=False)
+
+
+# Group the sheet by its slicer columns once instead of scanning it per combination
+def build_slicer_index(df: pd.DataFrame, normalized: dict) -> dict:
+    """
+    Map each tuple of slicer values to the row positions holding it.
+    Tuples follow the slicer order of `normalized` (from prepare_sheet()).
+    """
+    if not normalized:
+        return {}
+
+    indices = df.groupby(list(normalized.values()), sort=False, observed=True).indices
+
+    # A single grouping key yields scalar keys - normalise to tuples
+    return {(key if isinstance(key, tuple) else (key,)): rows for key, rows in indices.items()}
+
+
+# Aggregations reported per numeric column in the summary pivot, in kernel output order
+SUMMARY_METRICS = ['Sum', 'Average', 'Count', 'Min', 'Max']
+
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, cache=True)
+    def _groupby_agg5(group_ids, values, n_groups):
+        """Sum/mean/count/min/max per (group, column) in one scan; rows with group id -1 and NaNs are skipped"""
+        n_rows, n_cols = values.shape
+        out = np.empty((n_groups, n_cols, 5))
+        for j in prange(n_cols):
+            for g in range(n_groups):
+                out[g, j, 0] = 0.0
+                out[g, j, 2] = 0.0
+                out[g, j, 3] = np.inf
+                out[g, j, 4] = -np.inf
+            for i in range(n_rows):
+                g = group_ids[i]
+                v = values[i, j]
+                if g < 0 or np.isnan(v):
+                    continue
+                out[g, j, 0] += v
+                out[g, j, 2] += 1.0
+                if v < out[g, j, 3]:
+                    out[g, j, 3] = v
+                if v > out[g, j, 4]:
+                    out[g, j, 4] = v
+            for g in range(n_groups):
+                if out[g, j, 2] > 0:
+                    out[g, j, 1] = out[g, j, 0] / out[g, j, 2]
+                else:
+                    out[g, j, 1] = np.nan
+                    out[g, j, 3] = np.nan
+                    out[g, j, 4] = np.nan
+        return out
+
+
+# Compute every slicer group's numeric summary up front instead of once per combination
+def build_group_summaries(df: pd.DataFrame, slicer_index: dict) -> dict:
+    """
+    Return {'columns': numeric columns, 'groups': {key: (n_columns, 5) stats array}} for
+    every key of `slicer_index`, with stats ordered as SUMMARY_METRICS.
+    """
+    numeric_columns = df.select_dtypes(include=['number']).columns
+    keys = list(slicer_index)
+    if len(numeric_columns) == 0 or not keys:
+        return {'columns': numeric_columns, 'groups': {}}
+
+    group_ids = np.full(len(df), -1, dtype=np.int64)
+    for group_id, key in enumerate(keys):
+        group_ids[slicer_index[key]] = group_id
+
+    if NUMBA_AVAILABLE:
+        values = df[numeric_columns].to_numpy(dtype=np.float64, na_value=np.nan)
+        stats = _groupby_agg5(group_ids, values, len(keys))
+    else:
+        in_group = group_ids >= 0
+        stats = (df.loc[in_group, numeric_columns]
+                 .groupby(group_ids[in_group])
+                 .agg(['sum', 'mean', 'count', 'min', 'max'])
+                 .reindex(range(len(keys)))
+                 .to_numpy(dtype=np.float64, na_value=np.nan)
+                 .reshape(len(keys), len(numeric_columns), 5))
+
+    return {'columns': numeric_columns, 'groups': {key: stats[i] for i, key in enumerate(keys)}}
+
+
+def _summary_frame(columns, stats: np.ndarray) -> pd.DataFrame:
+    summary_df = pd.DataFrame(stats, columns=SUMMARY_METRICS).astype({'Count': 'int64'})
+    summary_df.insert(0, 'Metric', list(columns))
+    return summary_df
+
 
 # Basic filtering function
 def extract_pivot_views(df: pd.DataFrame, column_name: str, values: list) -> dict:
+    # Views are read-only slices of `df`; no defensive copies
     output = {}
+    column = df[column_name]
     for val in values:
-        filtered = df[df[column_name] == val].copy()
-        output[val] = filtered
+        output[val] = df.loc[column.eq(val)]
     return output
 
 
 # Cross-platform approach: Extract unique values from raw data
-def get_unique_slicer_values(file_path: str, sheet_name: str, slicer_name: str) -> list:
+def get_unique_slicer_values(file_path: str, sheet_name: str, slicer_name: str,
+                             df: pd.DataFrame = None, column=None) -> list:
     """
     Cross-platform approach: Extract unique values directly from Excel data
     Since we can't use COM on macOS, we'll read the raw data and find unique values
+
+    Pass a pre-loaded `df` and/or an already resolved `column` to skip the reload and column lookup.
     """
     print(f"Getting unique values for '{slicer_name}' in sheet '{sheet_name}'")
 
     try:
         # Load the data
-        df = load_excel_data(file_path, sheet_name)
+        if df is None:
+            df = load_excel_data(file_path, sheet_name)
 
         # Look for the column in various forms (case-insensitive, partial match)
-        possible_columns = []
-        for col in df.columns:
-            col_str = str(col).strip()
-            if (slicer_name.lower() in col_str.lower() or
-                    col_str.lower() in slicer_name.lower() or
-                    col_str.lower() == slicer_name.lower()):
-                possible_columns.append(col)
-
-        if not possible_columns:
-            # Try exact match first
-            if slicer_name in df.columns:
-                possible_columns = [slicer_name]
+        if column is None:
+            column = resolve_slicer_column(df, slicer_name)
 
-        if possible_columns:
-            column = possible_columns[0]
-
-            # Get unique values, excluding NaN and empty strings
-            unique_values = df[column].dropna().astype(str).str.strip()
-            unique_values = unique_values[unique_values != ''].unique().tolist()
+        if column is not None:
+            # Get unique values, excluding NaN and empty strings.
+            # Categories are the column's distinct non-null values, so only those get stringified.
+            unique_values = df[column].astype('category').cat.categories.astype('string').str.strip()
+            unique_values = unique_values[unique_values != ''].unique()
 
             # Remove any values that look like totals or summaries
-            filtered_values = []
-            skip_terms = ['total', 'grand total', 'sum', 'average', 'avg', '(blank)', 'blank']
-            for val in unique_values:
-                if not any(term in val.lower() for term in skip_terms):
-                    filtered_values.append(val)
+            filtered_values = unique_values[~_skip_term_mask(unique_values)].tolist()
 
             print(f"Found {len(filtered_values)} unique values for '{slicer_name}'")
             return filtered_values
@@ -82,35 +341,45 @@ def get_unique_slicer_values(file_path: str, sheet_name: str, slicer_name: str)
 
 
 # Cross-platform pivot simulation
-def refresh_pivot_and_read(file_path: str, sheet_name: str, slicer_values: dict) -> dict:
+def refresh_pivot_and_read(file_path: str, sheet_name: str, slicer_values: dict,
+                           df: pd.DataFrame = None, normalized: dict = None,
+                           slicer_index: dict = None, group_summaries: dict = None) -> dict:
     """
     Cross-platform approach: Simulate pivot table filtering by filtering raw data
+
+    Pass a pre-loaded `df` and its `normalized` slicer columns from prepare_sheet()
+    to avoid reloading and re-normalising the sheet for every combination.
+    With a `slicer_index` from build_slicer_index() each combination is a dict lookup
+    instead of a scan over the whole sheet, and `group_summaries` from
+    build_group_summaries() supplies its numeric summary without re-aggregating.
     """
     print(f"Applying filters: {slicer_values}")
 
     try:
         # Load the raw data
-        df = load_excel_data(file_path, sheet_name)
-
-        # Apply filters based on slicer values
-        filtered_df = df.copy()
-
-        for slicer_name, slicer_value in slicer_values.items():
-            # Find the matching column
-            matching_columns = []
-            for col in filtered_df.columns:
-                col_str = str(col).strip()
-                if (slicer_name.lower() in col_str.lower() or
-                        col_str.lower() in slicer_name.lower() or
-                        col_str.lower() == slicer_name.lower()):
-                    matching_columns.append(col)
+        if df is None:
+            df = load_excel_data(file_path, sheet_name)
+        if normalized is None:
+            normalized = prepare_sheet(df, list(slicer_values.keys()))
+
+        precomputed_stats = None
+
+        if slicer_index is not None and all(name in slicer_values for name in normalized):
+            # Look the combination up in the precomputed grouping
+            key = tuple(str(slicer_values[name]).strip() for name in normalized)
+            filtered_df = df.take(slicer_index.get(key, []))
+            if group_summaries is not None:
+                precomputed_stats = group_summaries['groups'].get(key)
+        else:
+            # Apply filters based on slicer values: every slicer is ANDed into one
+            # row mask and the sheet is sliced once, with no intermediate frames
+            mask = np.ones(len(df), dtype=bool)
 
-            if matching_columns:
-                column = matching_columns[0]
+            for slicer_name, slicer_value in slicer_values.items():
+                if slicer_name in normalized:
+                    mask &= _slicer_matches(normalized[slicer_name], str(slicer_value).strip())
 
-                # Apply filter
-                mask = filtered_df[column].astype(str).str.strip() == str(slicer_value).strip()
-                filtered_df = filtered_df[mask]
+            filtered_df = df[mask]
 
         # Create simulated pivot tables
         pivot_dfs = {}
@@ -125,21 +394,19 @@ def refresh_pivot_and_read(file_path: str, sheet_name: str, slicer_values: dict)
             if len(numeric_columns) > 0:
                 summary_name = f"Summary_{sheet_name}"
 
-                # Create a simple summary
-                summary_data = []
-                for col in numeric_columns:
-                    summary_data.append({
-                        'Metric': col,
-                        'Sum': filtered_df[col].sum(),
-                        'Average': filtered_df[col].mean(),
-                        'Count': filtered_df[col].count(),
-                        'Min': filtered_df[col].min(),
-                        'Max': filtered_df[col].max()
-                    })
-
-                if summary_data:
-                    summary_df = pd.DataFrame(summary_data)
-                    pivot_dfs[summary_name] = summary_df
+                if precomputed_stats is not None:
+                    summary_df = _summary_frame(group_summaries['columns'], precomputed_stats)
+                else:
+                    # Create a simple summary - one aggregation pass over all numeric columns
+                    summary_df = (filtered_df[numeric_columns]
+                                  .agg(['sum', 'mean', 'count', 'min', 'max'])
+                                  .T
+                                  .rename(columns={'sum': 'Sum', 'mean': 'Average', 'count': 'Count',
+                                                   'min': 'Min', 'max': 'Max'})
+                                  .astype({'Count': 'int64'})
+                                  .rename_axis('Metric')
+                                  .reset_index())
+                pivot_dfs[summary_name] = summary_df
 
         else:
             print("No data remaining after filtering")
@@ -154,19 +421,28 @@ def refresh_pivot_and_read(file_path: str, sheet_name: str, slicer_values: dict)
 
 
 # Debug function for cross-platform
-def debug_excel_structure(file_path: str, sheet_name: str):
-    """Debug function that works on all platforms"""
+def debug_excel_structure(file_path: str, sheet_name: str, df: pd.DataFrame = None, total_rows: int = None):
+    """Debug function that works on all platforms
+
+    `df` may be a sample from read_sheet_probe(); pass the sheet's `total_rows` to report
+    the real shape. Unique counts are then based on the sampled rows.
+    """
     print(f"Analyzing sheet '{sheet_name}':")
 
     try:
         # Load the sheet
-        df = load_excel_data(file_path, sheet_name)
+        if df is None:
+            df = load_excel_data(file_path, sheet_name)
 
-        print(f"  Shape: {df.shape[0]} rows × {df.shape[1]} columns")
+        row_count = total_rows if total_rows is not None else df.shape[0]
+        print(f"  Shape: {row_count} rows × {df.shape[1]} columns")
         print(f"  Columns: {list(df.columns)}")
 
         # Check for potential slicer columns (columns with reasonable number of unique values)
-        print(f"  Potential slicer columns:")
+        if total_rows is not None and total_rows != len(df):
+            print(f"  Potential slicer columns (from the first {len(df)} rows):")
+        else:
+            print(f"  Potential slicer columns:")
         for col in df.columns:
             unique_count = df[col].nunique()
             if 1 < unique_count <= 50:  # Reasonable range for slicer values
@@ -185,12 +461,18 @@ def analyze_excel_file_structure(file_path: str):
 
     try:
         # Get all sheet names
-        if file_path.endswith('.xlsb'):
-            xl_file = pd.ExcelFile(file_path, engine='pyxlsb')
-        else:
-            xl_file = pd.ExcelFile(file_path, engine='openpyxl')
+        try:
+            xl_file = pd.ExcelFile(file_path, engine='calamine')
+            sheet_names = xl_file.sheet_names
+        except ImportError:
+            if file_path.endswith('.xlsb'):
+                xl_file = pd.ExcelFile(file_path, engine='pyxlsb')
+                sheet_names = xl_file.sheet_names
+            else:
+                # Read-only mode opens the workbook without parsing every cell
+                xl_file = openpyxl.load_workbook(file_path, read_only=True, keep_links=False)
+                sheet_names = xl_file.sheetnames
 
-        sheet_names = xl_file.sheet_names
         print(f"Found {len(sheet_names)} sheets: {sheet_names}")
 
         xl_file.close()
@@ -1,11 +1,17 @@
 # main.py (Cross-platform version)
 
 # Import Excel and OpenAI utilities
-from excel import get_unique_slicer_values, refresh_pivot_and_read, debug_excel_structure, analyze_excel_file_structure
-from open_ai import analyze_dataframe, batch_analyze_dataframes
+from excel import (get_unique_slicer_values, refresh_pivot_and_read, debug_excel_structure,
+                   analyze_excel_file_structure, load_excel_data, resolve_slicer_columns,
+                   prepare_sheet, build_slicer_index, build_group_summaries,
+                   read_sheet_probe, select_analysis_columns)
+from open_ai import analyze_dataframes
+from concurrent.futures import ProcessPoolExecutor
 from itertools import product
+import math
 import os
 from datetime import datetime
+from pathlib import Path
 
 # === Configuration ===
 file_path = "CPRJune-25.xlsb"
@@ -16,55 +22,121 @@ sheets_to_analyze = [
     {"sheet": "CPR Common Size", "slicers": ["Client", "Type"]}
 ]
 
+# Pivots queued before their OpenAI analyses are sent off together
+ANALYSIS_CHUNK_SIZE = 50
 
-# Generate all possible slicer value combinations
+
+# Generate all possible slicer value combinations (lazily - combinations are consumed one at a time)
 def generate_slicer_combinations(slicer_values_map):
     keys = list(slicer_values_map.keys())
-    values_product = list(product(*[slicer_values_map[k] for k in keys]))
-    return [dict(zip(keys, combination)) for combination in values_product]
+    for combination in product(*[slicer_values_map[k] for k in keys]):
+        yield dict(zip(keys, combination))
+
+
+# Number of combinations generate_slicer_combinations will yield, without building them
+def count_slicer_combinations(slicer_values_map):
+    return math.prod(len(values) for values in slicer_values_map.values())
+
 
+def save_analysis_result(sheet_name: str, pivot_name: str, combo: dict, analysis: str, data_shape: tuple):
+    """Save analysis results to a file for later review"""
+    try:
+        # Create results directory if it doesn't exist
+        results_dir = "analysis_results"
+        os.makedirs(results_dir, exist_ok=True)
 
-# === Analyze entire file structure first ===
-print("Analyzing Excel file structure...")
-analyze_excel_file_structure(file_path)
+        # Create filename with timestamp
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        combo_str = "_".join([f"{k}-{v}" for k, v in combo.items()])
+        filename = f"{results_dir}/{sheet_name}_{pivot_name}_{combo_str}_{timestamp}.txt"
 
-# === Debug specific sheets ===
-print("\nAnalyzing target sheets...")
-for config in sheets_to_analyze:
-    debug_excel_structure(file_path, config["sheet"])
+        # Build the whole report first so it's encoded and written in one call
+        text = (f"Analysis Results\n"
+                f"================\n"
+                f"Timestamp: {datetime.now().isoformat()}\n"
+                f"Sheet: {sheet_name}\n"
+                f"Pivot Table: {pivot_name}\n"
+                f"Filters Applied: {combo}\n"
+                f"Data Shape: {data_shape[0]} rows × {data_shape[1]} columns\n"
+                f"\nAnalysis:\n"
+                f"---------\n"
+                f"{analysis}"
+                f"\n\nEnd of Analysis\n")
+
+        # Sheets are processed in parallel - publish atomically so a reader never sees a partial file
+        tmp_path = Path(f"{filename}.tmp")
+        tmp_path.write_text(text, encoding='utf-8')
+        os.replace(tmp_path, filename)
 
-# === Process each sheet ===
-for config in sheets_to_analyze:
+        print(f"    Analysis saved to: {filename}")
+
+    except Exception as e:
+        print(f"    Could not save analysis: {e}")
+
+
+# Stage 1 (worker process): parse the sheet and collect slicer values
+def collect_slicer_values(config):
+    """
+    Debug the sheet and return ({slicer: values}, usecols), or None if the values could not be read.
+    `usecols` is the column positions the sheet was loaded with (None means every column).
+    """
     sheet = config["sheet"]
     slicer_fields = config["slicers"]
 
-    print(f"\nProcessing sheet: {sheet} using slicers: {slicer_fields}")
-
     slicer_values_map = {}
     try:
+        # Keep only the slicer and numeric columns, found by probing the sheet with every column
+        probe = read_sheet_probe(file_path, sheet)
+        usecols = select_analysis_columns(probe, slicer_fields)
+
+        # Load the sheet once and resolve slicer columns once; everything below reuses them
+        sheet_df = load_excel_data(file_path, sheet, usecols=usecols)
+
+        # Debug on the probe so every column is considered as a slicer candidate
+        debug_excel_structure(file_path, sheet, df=probe, total_rows=len(sheet_df))
+
+        print(f"\nProcessing sheet: {sheet} using slicers: {slicer_fields}")
+
+        slicer_columns = resolve_slicer_columns(sheet_df, slicer_fields)
+
         # Get all values for each slicer field
         for slicer in slicer_fields:
-            slicer_values_map[slicer] = get_unique_slicer_values(file_path, sheet, slicer)
+            slicer_values_map[slicer] = get_unique_slicer_values(file_path, sheet, slicer,
+                                                                 df=sheet_df, column=slicer_columns[slicer])
             print(f"  Values for '{slicer}': {len(slicer_values_map[slicer])} found")
     except Exception as e:
         print(f"Failed to get slicer values: {e}")
-        continue
+        return None
+
+    return slicer_values_map, usecols
+
+
+# Stage 2 (same worker process): filter and analyze every slicer combination
+def process_sheet(config, slicer_values_map, usecols=None):
+    sheet = config["sheet"]
+    slicer_fields = config["slicers"]
+
+    # Served from this worker's sheet cache, populated in collect_slicer_values.
+    # The sheet and the pivots sliced from it are read-only - never modify them in place.
+    sheet_df = load_excel_data(file_path, sheet, usecols=usecols)
+    normalized = prepare_sheet(sheet_df, slicer_fields)
+    slicer_index = build_slicer_index(sheet_df, normalized)
+    group_summaries = build_group_summaries(sheet_df, slicer_index)
 
     # Generate every combination of slicer values (Cartesian product)
     slicer_combinations = generate_slicer_combinations(slicer_values_map)
-    print(f"  Total combinations to process: {len(slicer_combinations)}")
+    total_combinations = count_slicer_combinations(slicer_values_map)
 
-    if len(slicer_combinations) > 20:
-        print(f"  Large number of combinations detected!")
-        response = input(f"  Continue with {len(slicer_combinations)} combinations? (y/n): ")
-        if response.lower() != 'y':
-            print(f"  Skipping sheet {sheet}")
-            continue
+    # Pivots waiting for OpenAI analysis; sent concurrently in chunks of ANALYSIS_CHUNK_SIZE
+    pending = []
 
     for combo_idx, combo in enumerate(slicer_combinations, 1):
-        print(f"\n  Analyzing combination {combo_idx}/{len(slicer_combinations)}: {combo}")
+        print(f"\n  Analyzing combination {combo_idx}/{total_combinations}: {combo}")
         try:
-            pivot_dataframes = refresh_pivot_and_read(file_path, sheet, combo)
+            pivot_dataframes = refresh_pivot_and_read(file_path, sheet, combo,
+                                                      df=sheet_df, normalized=normalized,
+                                                      slicer_index=slicer_index,
+                                                      group_summaries=group_summaries)
 
             if not pivot_dataframes:
                 print(f"    No data returned for combo {combo}")
@@ -79,64 +151,93 @@ for config in sheets_to_analyze:
 
                 # Check if DataFrame has meaningful data (more than just headers or single summary row)
                 if len(df) >= 1 and len(df.columns) > 0:
-                    print(f"    Running OpenAI analysis...")
-
-                    try:
-                        # Prepare context for OpenAI analysis
-                        analysis_context = {
-                            'sheet_name': sheet,
-                            'pivot_name': pivot_name,
-                            'filters': combo,
-                            'combination_number': f"{combo_idx}/{len(slicer_combinations)}"
-                        }
-
-                        # Call enhanced OpenAI analysis
-                        result = analyze_dataframe(df, analysis_context)
-
-                        print(f"\n    OpenAI Analysis Results:")
-                        print(f"    Sheet: {sheet} | Pivot: {pivot_name} | Filters: {combo}")
-                        print("    " + "=" * 80)
-                        print(result)
-                        print("    " + "=" * 80)
-
-                        # Save results to file
-                        save_analysis_result(sheet, pivot_name, combo, result, df.shape)
-
-                    except Exception as ai_error:
-                        print(f"    OpenAI analysis failed: {ai_error}")
+                    print(f"    Queued for OpenAI analysis")
+
+                    # Prepare context for OpenAI analysis
+                    analysis_context = {
+                        'sheet_name': sheet,
+                        'pivot_name': pivot_name,
+                        'filters': combo,
+                        'combination_number': f"{combo_idx}/{total_combinations}"
+                    }
+                    pending.append((df, analysis_context))
                 else:
                     print(f"    Insufficient data for analysis (only {len(df)} rows)")
 
         except Exception as err:
             print(f"  Failed for slicer combo {combo}: {err}")
 
+        if len(pending) >= ANALYSIS_CHUNK_SIZE:
+            run_pending_analyses(pending)
+            pending = []
 
-def save_analysis_result(sheet_name: str, pivot_name: str, combo: dict, analysis: str, data_shape: tuple):
-    """Save analysis results to a file for later review"""
+    run_pending_analyses(pending)
+
+
+def run_pending_analyses(pending):
+    """Run OpenAI analysis for queued (df, context) pairs concurrently, then report and save in order"""
+    if not pending:
+        return
+
+    print(f"\n    Running OpenAI analysis for {len(pending)} pivot tables...")
     try:
-        # Create results directory if it doesn't exist
-        results_dir = "analysis_results"
-        os.makedirs(results_dir, exist_ok=True)
+        # Call enhanced OpenAI analysis
+        results = analyze_dataframes(pending)
+    except Exception as ai_error:
+        print(f"    OpenAI analysis failed: {ai_error}")
+        return
 
-        # Create filename with timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        combo_str = "_".join([f"{k}-{v}" for k, v in combo.items()])
-        filename = f"{results_dir}/{sheet_name}_{pivot_name}_{combo_str}_{timestamp}.txt"
+    for (df, context), result in zip(pending, results):
+        sheet, pivot_name, combo = context['sheet_name'], context['pivot_name'], context['filters']
 
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write(f"Analysis Results\n")
-            f.write(f"================\n")
-            f.write(f"Timestamp: {datetime.now().isoformat()}\n")
-            f.write(f"Sheet: {sheet_name}\n")
-            f.write(f"Pivot Table: {pivot_name}\n")
-            f.write(f"Filters Applied: {combo}\n")
-            f.write(f"Data Shape: {data_shape[0]} rows × {data_shape[1]} columns\n")
-            f.write(f"\nAnalysis:\n")
-            f.write(f"---------\n")
-            f.write(analysis)
-            f.write(f"\n\nEnd of Analysis\n")
+        print(f"\n    OpenAI Analysis Results:")
+        print(f"    Sheet: {sheet} | Pivot: {pivot_name} | Filters: {combo}")
+        print("    " + "=" * 80)
+        print(result)
+        print("    " + "=" * 80)
 
-        print(f"    Analysis saved to: {filename}")
+        # Save results to file
+        save_analysis_result(sheet, pivot_name, combo, result, df.shape)
 
-    except Exception as e:
-        print(f"    Could not save analysis: {e}")
\ No newline at end of file
+
+if __name__ == "__main__":
+    # === Analyze entire file structure first ===
+    print("Analyzing Excel file structure...")
+    analyze_excel_file_structure(file_path)
+
+    # Sheets are independent, so each gets its own worker process. One single-worker
+    # pool per sheet keeps both stages on the same process and its parsed-sheet cache.
+    executors = [ProcessPoolExecutor(max_workers=1) for _ in sheets_to_analyze]
+    try:
+        # === Debug specific sheets and collect slicer values (in parallel) ===
+        print("\nAnalyzing target sheets...")
+        value_futures = [executor.submit(collect_slicer_values, config)
+                         for executor, config in zip(executors, sheets_to_analyze)]
+
+        # === Process each sheet (in parallel) ===
+        sheet_futures = []
+        for executor, config, future in zip(executors, sheets_to_analyze, value_futures):
+            sheet = config["sheet"]
+            collected = future.result()
+            if collected is None:
+                continue
+            slicer_values_map, usecols = collected
+
+            total_combinations = count_slicer_combinations(slicer_values_map)
+            print(f"  Total combinations to process for {sheet}: {total_combinations}")
+
+            # Prompt here - worker processes have no interactive stdin
+            if total_combinations > 20:
+                print(f"  Large number of combinations detected!")
+                response = input(f"  Continue with {total_combinations} combinations? (y/n): ")
+                if response.lower() != 'y':
+                    print(f"  Skipping sheet {sheet}")
+                    continue
+
+            sheet_futures.append(executor.submit(process_sheet, config, slicer_values_map, usecols))
+
+        for future in sheet_futures:
+            future.result()
+    finally:
+        for executor in executors:
+            executor.shutdown()
@@ -1,23 +1,80 @@
 # open_ai.py (Enhanced version)
 
-import openai
+import asyncio
+import hashlib
+import json
 import os
+import re
+import tempfile
 import pandas as pd
-from typing import Dict, Any
+from pathlib import Path
+from openai import OpenAI, AsyncOpenAI
+from typing import Dict, Any, List, Tuple
 
 # Load OpenAI key
-openai.api_key = os.getenv("OPENAI_API_KEY") or "your-api-key-here"
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY") or "your-api-key-here"
 
+client = OpenAI(api_key=OPENAI_API_KEY)
 
-def analyze_dataframe(df: pd.DataFrame, context: Dict[str, Any] = None) -> str:
-    """
-    Enhanced DataFrame analysis with better context and structured output
-    """
+MODEL = "gpt-4"
+MAX_TOKENS = 1500
+# Prompt + completion tokens the model accepts (gpt-4: 8k)
+CONTEXT_WINDOW = 8192
+
+# Concurrent requests in flight, and at most how many small pivots share one prompt.
+# Batches are also capped so the prompt plus MAX_TOKENS per pivot fits CONTEXT_WINDOW.
+MAX_CONCURRENT_REQUESTS = 10
+PIVOTS_PER_PROMPT = 5
+# Pivots up to this many rows are small enough to be batched into a shared prompt
+BATCHABLE_MAX_ROWS = 20
+
+SYSTEM_PROMPT = "You are an expert financial analyst with deep experience in corporate financial reporting, variance analysis, and business intelligence. Provide clear, actionable insights."
+
+ANALYSIS_INSTRUCTIONS = """
+    Please provide a comprehensive financial analysis including:
+
+    1. **Key Insights**: What are the main takeaways from this data?
+    2. **Trends & Patterns**: Identify any notable trends, anomalies, or patterns
+    3. **Financial Metrics**: Comment on important financial indicators present
+    4. **Risk Assessment**: Highlight any potential risks or concerning areas
+    5. **Recommendations**: Suggest actionable next steps or areas for further investigation
+    6. **Data Quality**: Comment on data completeness and reliability
+
+    Focus on actionable insights that would be valuable to management.
+    Keep your analysis concise but thorough.
+"""
+
+# Frames this small (e.g. the Summary pivot) are sent whole as a plain table instead of a JSON profile
+RAW_TABLE_MAX_ROWS = 10
+RAW_TABLE_MAX_COLUMNS = 6
+
+# describe() statistics kept in the JSON profile: numeric/date columns get mean, min, median
+# and max, text columns their number of distinct values (top values are listed separately)
+PROFILE_STATS = ['unique', 'mean', 'min', '50%', 'max']
+
+# Above this many cells the summary skips the per-column missing-data scan
+MISSING_DATA_SCAN_MAX_CELLS = 1_000_000
+
+# Completed responses, keyed by a hash of the request, so identical prompts are only sent once
+CACHE_DIR = Path(".openai_cache")
+
+# Marks the start of each answer in a batched response: "### Analysis 2", "**Analysis 2:** text",
+# "2. Analysis 2 - text" ... - a heading/bold/numbered-list prefix, or "Analysis 2" alone on its line,
+# so prose like "Analysis 2 shows..." is not a header. Text after the ":"/"-" separator is body.
+_BATCH_HEADER_RE = re.compile(r"^[ \t]*(?:(?:#{1,6}[ \t]*|\d+[.)][ \t]*)+(?:\*\*|__)?|\*\*|__"
+                              r"|(?=Analysis[ \t]+#?\d+[ \t]*:?[ \t]*$))"
+                              r"[ \t]*Analysis[ \t]+#?(\d+)\b"
+                              r"[ \t]*(?:\*\*|__)?[ \t]*[:.\-–—]?[ \t]*(?:\*\*|__)?",
+                              re.MULTILINE | re.IGNORECASE)
+
+
+def describe_dataset(df: pd.DataFrame, context: Dict[str, Any] = None) -> str:
+    """Context line, data summary and either the whole (small) table or a JSON profile for one DataFrame"""
     if context is None:
         context = {}
 
-    # Generate data summary for the prompt
-    data_summary = generate_data_summary(df)
+    # Shape and gaps only - the table or profile below already covers the columns and their statistics
+    data_summary = generate_data_summary(df, brief=True)
 
     # Create context string
     context_str = ""
@@ -31,51 +88,300 @@ def analyze_dataframe(df: pd.DataFrame, context: Dict[str, Any] = None) -> str:
             context_items.append(f"Applied Filters: {context['filters']}")
         context_str = " | ".join(context_items)
 
-    prompt = f"""
-    You are a financial analyst reviewing pivot table data from an Excel report.
+    if len(df) <= RAW_TABLE_MAX_ROWS and df.shape[1] <= RAW_TABLE_MAX_COLUMNS:
+        data = f"""Data:
+    {df.to_string(index=False)}"""
+    else:
+        data = f"""Data Profile (JSON: per-column dtype and statistics, top categories):
+    {generate_data_profile(df)}"""
 
+    return f"""
     {f"Context: {context_str}" if context_str else ""}
 
     Data Summary:
     {data_summary}
 
-    Raw Data (first 10 rows):
-    {df.head(10).to_string(index=False)}
+    {data}
+"""
 
-    Please provide a comprehensive financial analysis including:
 
-    1. **Key Insights**: What are the main takeaways from this data?
-    2. **Trends & Patterns**: Identify any notable trends, anomalies, or patterns
-    3. **Financial Metrics**: Comment on important financial indicators present
-    4. **Risk Assessment**: Highlight any potential risks or concerning areas
-    5. **Recommendations**: Suggest actionable next steps or areas for further investigation
-    6. **Data Quality**: Comment on data completeness and reliability
+def generate_data_profile(df: pd.DataFrame) -> str:
+    """Compact JSON profile of the DataFrame - far fewer tokens than raw rows"""
+    # One entry per column (dtype plus its statistics), so each column name is sent once
+    columns = {str(col): {'dtype': str(dtype)} for col, dtype in df.dtypes.items()}
 
-    Focus on actionable insights that would be valuable to management.
-    Keep your analysis concise but thorough.
+    if df.shape[1] > 0:
+        described = df.describe(include='all', percentiles=[.5])
+        described = described.loc[described.index.intersection(PROFILE_STATS, sort=False)].round(3)
+        for col, values in described.items():
+            columns[str(col)].update(values.dropna().to_dict())
+
+    text_cols = df.select_dtypes(include=['object', 'string', 'category']).columns[:5]
+    top_categories = {
+        str(col): {str(value): int(count) for value, count in df[col].value_counts().head(5).items() if count > 0}
+        for col in text_cols
+    }
+
+    profile = {'columns': columns, 'top_categories': top_categories}
+    return json.dumps(profile, separators=(',', ':'), default=str)
+
+
+def build_analysis_prompt(df: pd.DataFrame, context: Dict[str, Any] = None) -> str:
+    """Prompt asking for the analysis of a single DataFrame"""
+    return _analysis_prompt(describe_dataset(df, context))
+
+
+def _analysis_prompt(description: str) -> str:
+    return f"""
+    You are a financial analyst reviewing pivot table data from an Excel report.
+{description}{ANALYSIS_INSTRUCTIONS}"""
+
+
+def build_batch_prompt(items: List[Tuple[pd.DataFrame, Dict[str, Any]]]) -> str:
+    """Prompt asking for separate, numbered analyses of several small DataFrames"""
+    return _batch_prompt([describe_dataset(df, context) for df, context in items])
+
+
+def _batch_section(number: int, description: str) -> str:
+    return f"\n    ### Dataset {number}\n{description}"
+
+
+def _batch_prompt(descriptions: List[str]) -> str:
+    datasets = "".join(_batch_section(i, description) for i, description in enumerate(descriptions, 1))
+
+    return f"""
+    You are a financial analyst reviewing {len(descriptions)} pivot tables from an Excel report.
+{datasets}
+    For EACH dataset, write a separate analysis. Start each one with a line of the form
+    "### Analysis N" where N is the dataset number, and do not refer to the other datasets.
+{ANALYSIS_INSTRUCTIONS}"""
+
+
+def split_batch_response(text: str, count: int, truncated: bool = False) -> List[str]:
+    """
+    Split a numbered batch response back into per-dataset analyses (None where missing).
+    With `truncated` the response was cut off, so its last analysis is incomplete and dropped.
+    """
+    results = [None] * count
+    headers = list(_BATCH_HEADER_RE.finditer(text))
+    for header, next_header in zip(headers, headers[1:] + [None]):
+        number = int(header.group(1))
+        if next_header is None and truncated:
+            break
+        if 1 <= number <= count:
+            body = text[header.end():next_header.start() if next_header else len(text)].strip()
+            results[number - 1] = body or None
+    return results
+
+
+def estimate_tokens(text: str) -> int:
+    """Conservative token estimate (~3 characters per token for prose mixed with JSON)"""
+    return len(text) // 3 + 1
+
+
+def plan_batches(descriptions: List[str], pivots_per_prompt: int = PIVOTS_PER_PROMPT) -> List[List[int]]:
+    """
+    Group dataset descriptions (from describe_dataset()) into batches of positions, at most
+    `pivots_per_prompt` each, keeping each batch's prompt plus MAX_TOKENS of completion per
+    pivot inside CONTEXT_WINDOW. Each description is measured once.
+    """
+    # The numbered section header is a few tokens at most, whatever the number
+    base_tokens = estimate_tokens(SYSTEM_PROMPT) + estimate_tokens(_batch_prompt([]))
+    item_tokens = [estimate_tokens(_batch_section(1, description)) + MAX_TOKENS for description in descriptions]
+
+    batches, current, current_tokens = [], [], base_tokens
+    for i, tokens in enumerate(item_tokens):
+        if current and (len(current) >= pivots_per_prompt or current_tokens + tokens > CONTEXT_WINDOW):
+            batches.append(current)
+            current, current_tokens = [], base_tokens
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _cache_path(prompt: str, max_tokens: int) -> Path:
+    # The system prompt/model hash prefixes the name, so changing either invalidates old entries
+    system_key = hashlib.blake2b(f"{MODEL}\n{SYSTEM_PROMPT}".encode(), digest_size=8).hexdigest()
+    prompt_key = hashlib.blake2b(f"{max_tokens}\n{prompt}".encode(), digest_size=16).hexdigest()
+    return CACHE_DIR / f"{system_key}_{prompt_key}.txt"
+
+
+def _read_cached(prompt: str, max_tokens: int):
+    path = _cache_path(prompt, max_tokens)
+    try:
+        return path.read_text(encoding='utf-8')
+    except OSError:
+        return None
+
+
+def _write_cached(prompt: str, max_tokens: int, text: str):
+    """Store a response atomically (write a temp file, then rename) so readers never see partial files"""
+    path = _cache_path(prompt, max_tokens)
+    try:
+        CACHE_DIR.mkdir(exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"⚠️ Could not cache OpenAI response: {e}")
+
+
+def _error_analysis(df: pd.DataFrame, error: Exception) -> str:
+    return f"❌ OpenAI Analysis Error: {str(error)}\n\nFallback Analysis:\n{generate_fallback_analysis(df)}"
+
+
+def _messages(prompt: str) -> list:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+
+def analyze_dataframe(df: pd.DataFrame, context: Dict[str, Any] = None) -> str:
+    """
+    Enhanced DataFrame analysis with better context and structured output
     """
+    prompt = build_analysis_prompt(df, context)
+
+    cached = _read_cached(prompt, MAX_TOKENS)
+    if cached is not None:
+        return cached
 
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are an expert financial analyst with deep experience in corporate financial reporting, variance analysis, and business intelligence. Provide clear, actionable insights."
-                },
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=1500,
+        response = client.chat.completions.create(
+            model=MODEL,
+            messages=_messages(prompt),
+            max_tokens=MAX_TOKENS,
+            temperature=0.3
+        )
+        choice = response.choices[0]
+        text = choice.message.content.strip()
+        if choice.finish_reason == 'length':
+            print(f"⚠️ OpenAI analysis hit the {MAX_TOKENS}-token limit and may be incomplete (not cached)")
+        else:
+            _write_cached(prompt, MAX_TOKENS, text)
+        return text
+
+    except Exception as e:
+        return _error_analysis(df, e)
+
+
+async def _complete_async(async_client: AsyncOpenAI, semaphore: asyncio.Semaphore,
+                          prompt: str, max_tokens: int) -> Tuple[str, str]:
+    """Return (text, finish_reason); responses cut off at max_tokens are never cached"""
+    cached = _read_cached(prompt, max_tokens)
+    if cached is not None:
+        return cached, 'stop'
+
+    async with semaphore:
+        response = await async_client.chat.completions.create(
+            model=MODEL,
+            messages=_messages(prompt),
+            max_tokens=max_tokens,
             temperature=0.3
         )
-        return response['choices'][0]['message']['content'].strip()
+    choice = response.choices[0]
+    text = choice.message.content.strip()
+    if choice.finish_reason != 'length':
+        _write_cached(prompt, max_tokens, text)
+    return text, choice.finish_reason
 
+
+async def _analyze_one_async(async_client, semaphore, df, context, description: str = None) -> str:
+    try:
+        if description is None:
+            description = describe_dataset(df, context)
+        text, finish_reason = await _complete_async(async_client, semaphore,
+                                                    _analysis_prompt(description), MAX_TOKENS)
     except Exception as e:
-        return f"❌ OpenAI Analysis Error: {str(e)}\n\nFallback Analysis:\n{generate_fallback_analysis(df)}"
+        return _error_analysis(df, e)
+
+    if finish_reason == 'length':
+        print(f"⚠️ OpenAI analysis hit the {MAX_TOKENS}-token limit and may be incomplete (not cached)")
+    return text
 
 
-def generate_data_summary(df: pd.DataFrame) -> str:
-    """Generate a structured summary of the DataFrame"""
+async def _analyze_batch_async(async_client, semaphore, items, descriptions) -> List[str]:
+    """Analyze several small DataFrames with one request; re-ask individually for any unparsed answer"""
+    if len(items) == 1:
+        return [await _analyze_one_async(async_client, semaphore, *items[0], descriptions[0])]
+
+    try:
+        text, finish_reason = await _complete_async(async_client, semaphore, _batch_prompt(descriptions),
+                                                    MAX_TOKENS * len(items))
+        truncated = finish_reason == 'length'
+        results = split_batch_response(text, len(items), truncated=truncated)
+        if truncated:
+            print(f"⚠️ Batched analysis of {len(items)} pivots was cut off; re-asking the incomplete ones")
+    except Exception as e:
+        print(f"⚠️ Batched analysis of {len(items)} pivots failed, analyzing them one by one: {e}")
+        results = [None] * len(items)
+
+    missing = [i for i, result in enumerate(results) if result is None]
+    retried = await asyncio.gather(*[_analyze_one_async(async_client, semaphore, *items[i], descriptions[i])
+                                     for i in missing])
+    for i, result in zip(missing, retried):
+        results[i] = result
+    return results
+
+
+async def analyze_dataframes_async(items: List[Tuple[pd.DataFrame, Dict[str, Any]]],
+                                   max_concurrency: int = MAX_CONCURRENT_REQUESTS,
+                                   pivots_per_prompt: int = PIVOTS_PER_PROMPT) -> List[str]:
+    """
+    Analyze many (df, context) pairs concurrently; results are returned in input order.
+    Small DataFrames are grouped up to `pivots_per_prompt` per request, as far as the
+    context window allows (see plan_batches()).
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    results = [None] * len(items)
+
+    # Describe each small pivot once; one that can't be described falls back on its own
+    small, large, descriptions = [], [], {}
+    for i, (df, context) in enumerate(items):
+        if len(df) > BATCHABLE_MAX_ROWS:
+            large.append(i)
+            continue
+        try:
+            descriptions[i] = describe_dataset(df, context)
+            small.append(i)
+        except Exception as e:
+            results[i] = _error_analysis(df, e)
+
+    batches = [[small[p] for p in batch]
+               for batch in plan_batches([descriptions[i] for i in small], pivots_per_prompt)]
+
+    async with AsyncOpenAI(api_key=OPENAI_API_KEY) as async_client:
+        batch_results, large_results = await asyncio.gather(
+            asyncio.gather(*[_analyze_batch_async(async_client, semaphore, [items[i] for i in batch],
+                                                  [descriptions[i] for i in batch])
+                             for batch in batches]),
+            asyncio.gather(*[_analyze_one_async(async_client, semaphore, *items[i]) for i in large])
+        )
+
+    for batch, batch_result in zip(batches, batch_results):
+        for i, result in zip(batch, batch_result):
+            results[i] = result
+    for i, result in zip(large, large_results):
+        results[i] = result
+    return results
+
+
+def analyze_dataframes(items: List[Tuple[pd.DataFrame, Dict[str, Any]]], **kwargs) -> List[str]:
+    """Synchronous wrapper around analyze_dataframes_async"""
+    if not items:
+        return []
+    return asyncio.run(analyze_dataframes_async(items, **kwargs))
+
+
+def generate_data_summary(df: pd.DataFrame, brief: bool = False) -> str:
+    """Generate a structured summary of the DataFrame
+
+    `brief` keeps only the shape and missing-data lines, for prompts that list the columns elsewhere.
+    """
     summary_parts = []
 
     # Basic info
@@ -83,29 +389,32 @@ def generate_data_summary(df: pd.DataFrame) -> str:
 
     # Column info
     numeric_cols = df.select_dtypes(include=['number']).columns.tolist()
-    text_cols = df.select_dtypes(include=['object', 'string']).columns.tolist()
+    text_cols = df.select_dtypes(include=['object', 'string', 'category']).columns.tolist()
     date_cols = df.select_dtypes(include=['datetime']).columns.tolist()
 
-    if numeric_cols:
+    if numeric_cols and not brief:
         summary_parts.append(
-            f"Numeric columns ({len(numeric_cols)}): {', '.join(numeric_cols[:5])}{'...' if len(numeric_cols) > 5 else ''}")
-    if text_cols:
+            f"Numeric columns ({len(numeric_cols)}): {', '.join(map(str, numeric_cols[:5]))}{'...' if len(numeric_cols) > 5 else ''}")
+    if text_cols and not brief:
         summary_parts.append(
-            f"Text columns ({len(text_cols)}): {', '.join(text_cols[:5])}{'...' if len(text_cols) > 5 else ''}")
-    if date_cols:
-        summary_parts.append(f"Date columns ({len(date_cols)}): {', '.join(date_cols)}")
-
-    # Data quality
-    missing_data = df.isnull().sum()
-    if missing_data.sum() > 0:
-        cols_with_missing = missing_data[missing_data > 0]
-        summary_parts.append(f"Missing data: {cols_with_missing.to_dict()}")
+            f"Text columns ({len(text_cols)}): {', '.join(map(str, text_cols[:5]))}{'...' if len(text_cols) > 5 else ''}")
+    if date_cols and not brief:
+        summary_parts.append(f"Date columns ({len(date_cols)}): {', '.join(map(str, date_cols))}")
+
+    # Data quality - a full-frame scan, so skipped for very large frames
+    # (the JSON profile's per-column counts still expose gaps there)
+    if df.size <= MISSING_DATA_SCAN_MAX_CELLS:
+        missing_counts = df.isna().to_numpy().sum(axis=0)
+        if missing_counts.any():
+            cols_with_missing = {col: int(count) for col, count in zip(df.columns, missing_counts) if count}
+            summary_parts.append(f"Missing data: {cols_with_missing}")
 
     # Numeric summaries
-    if numeric_cols:
+    if numeric_cols and not brief:
         summary_parts.append("\nNumeric column summaries:")
-        for col in numeric_cols[:3]:  # First 3 numeric columns
-            stats = df[col].describe()
+        # First 3 numeric columns, described in one pass
+        described = df[numeric_cols[:3]].describe().T
+        for col, stats in described.iterrows():
             summary_parts.append(
                 f"  {col}: min={stats['min']:.2f}, max={stats['max']:.2f}, mean={stats['mean']:.2f}, std={stats['std']:.2f}")
 
@@ -129,7 +438,7 @@ def generate_fallback_analysis(df: pd.DataFrame) -> str:
             analysis_parts.append(f"- {col}: Total = {total:,.2f}, Average = {avg:,.2f}")
 
     # Categorical analysis
-    text_cols = df.select_dtypes(include=['object', 'string']).columns
+    text_cols = df.select_dtypes(include=['object', 'string', 'category']).columns
     if len(text_cols) > 0:
         analysis_parts.append(f"\nCATEGORICAL ANALYSIS:")
         for col in text_cols[:3]:  # First 3 text columns
@@ -137,7 +446,7 @@ def generate_fallback_analysis(df: pd.DataFrame) -> str:
             analysis_parts.append(f"- {col}: {unique_count} unique values")
 
     # Data quality
-    missing_count = df.isnull().sum().sum()
+    missing_count = int(df.isna().to_numpy().sum())
     if missing_count > 0:
         analysis_parts.append(f"\nDATA QUALITY:")
         analysis_parts.append(f"- {missing_count} missing values detected")
@@ -154,21 +463,25 @@ def batch_analyze_dataframes(dataframes_dict: Dict[str, pd.DataFrame], context:
     """
     Analyze multiple DataFrames in batch and return results
     """
-    results = {}
+    names = list(dataframes_dict.keys())
+    items = []
 
-    for name, df in dataframes_dict.items():
+    for name in names:
         print(f"🤖 Analyzing {name}...")
 
         # Add specific context for this dataframe
         df_context = context.copy() if context else {}
         df_context['pivot_name'] = name
+        items.append((dataframes_dict[name], df_context))
 
-        try:
-            analysis = analyze_dataframe(df, df_context)
-            results[name] = analysis
-            print(f"✅ Analysis complete for {name}")
-        except Exception as e:
-            results[name] = f"❌ Analysis failed: {str(e)}"
-            print(f"❌ Analysis failed for {name}: {e}")
+    try:
+        analyses = analyze_dataframes(items)
+    except Exception as e:
+        print(f"❌ Batch analysis failed: {e}")
+        return {name: f"❌ Analysis failed: {str(e)}" for name in names}
+
+    results = dict(zip(names, analyses))
+    for name in names:
+        print(f"✅ Analysis complete for {name}")
 
-    return results
\ No newline at end of file
+    return results